@@ -1,11 +1,19 @@
 import streamlit as st
 import sqlite3
 import hashlib
-import pandas as pd
-from datetime import datetime
-from groq import Groq
+import hmac
+import json
+import time
+import httpx
+from groq import DefaultHttpxClient, Groq
+from argon2 import PasswordHasher
+from argon2.exceptions import InvalidHashError, VerificationError
 import os
-import base64
+import re
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
 # --- 1. CONFIGURATION ---
 try:
@@ -13,98 +21,361 @@ try:
 except Exception:
     GROQ_API_KEY = ""
 
+DB_PATH = "medical_guardian.db"
+
+MODEL_FAST = "llama-3.1-8b-instant"
+MODEL_QUALITY = "llama-3.3-70b-versatile"
+FAST_MODEL_MAX_CHARS = 200
+RESPONSE_CACHE_TTL = 3600
+CHAT_CONTEXT_LIMIT = 8
+SUMMARY_EVERY = 8
+CHAT_PAGE_SIZE = 40
+# Concurrent reply streams across all sessions, and the longest wait for
+# the next token before the reply is given up on
+STREAM_WORKERS = 32
+STREAM_TIMEOUT = 60
+BATCH_ANSWER_MARKER = re.compile(r"^\s*\[(\d+)\]\s*", re.MULTILINE)
+# Quantities as digits, units or words ("one beer", "a couple of xanax")
+DOSAGE_PATTERN = re.compile(
+    r"\d|\b(mg|ml|mcg|doses?|dosages?|pills?|tablets?|units?"
+    r"|one|two|three|four|five|six|seven|eight|nine|ten|dozen|half"
+    r"|couple|few|several|many|much|twice)\b",
+    re.IGNORECASE
+)
+
+# argon2id, OWASP minimum profile (19 MiB, t=2, p=1): ~tens of ms per verify
+PASSWORD_HASHER = PasswordHasher(time_cost=2, memory_cost=19456, parallelism=1)
+
+@st.cache_resource
+def get_dummy_password_hash():
+    # Verified against on unknown usernames so a miss costs the same argon2
+    # work as a wrong password and timing doesn't reveal which names exist
+    return PASSWORD_HASHER.hash("guardian-ai-dummy-password")
+
+@st.cache_resource
+def get_groq_client():
+    # httpx closes idle connections after 5s by default, shorter than the
+    # gap between chat turns; keep them long enough to skip the TLS handshake.
+    return Groq(
+        api_key=GROQ_API_KEY,
+        http_client=DefaultHttpxClient(
+            limits=httpx.Limits(
+                max_connections=100,
+                max_keepalive_connections=20,
+                keepalive_expiry=120
+            )
+        )
+    )
+
+@st.cache_resource
+def get_executor():
+    # Best-effort background jobs: prompt-cache warm-ups and summaries
+    return ThreadPoolExecutor(max_workers=4)
+
+@st.cache_resource
+def get_stream_executor():
+    # Reply streams only, so background jobs never hold up a user's answer
+    return ThreadPoolExecutor(max_workers=STREAM_WORKERS)
+
+@st.cache_resource
+def get_summary_jobs():
+    # Users with a summary request in flight; at most one per user
+    return set()
+
 # --------------------------------------------------
 # FOOTER LOGO (DEPLOYMENT SAFE, FILE BASED)
 # --------------------------------------------------
-def render_footer_logo():
-    logo_path = "logo.png"
-
-    if not os.path.exists(logo_path):
-        return
-
-    try:
-        with open(logo_path, "rb") as f:
-            logo_b64 = base64.b64encode(f.read()).decode()
+# Served by Streamlit's static file server (.streamlit/config.toml), so the
+# browser fetches and caches the image once instead of receiving it inlined
+# as base64 with every rerun.
+LOGO_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static", "logo.png")
 
-        st.markdown(
-            f"""
+FOOTER_LOGO_HTML = """
             <style>
-            .footer-logo {{
+            .footer-logo {
                 position: fixed;
                 bottom: 600px;
                 left: 210px;
                 z-index: 999;
                 opacity: 0.9;
-            }}
+            }
             </style>
 
             <div class="footer-logo">
-                <img src="data:image/png;base64,{logo_b64}" width="120">
+                <img src="app/static/logo.png" width="120">
             </div>
-            """,
-            unsafe_allow_html=True
-        )
-    except Exception:
-        pass
+            """
+
+def render_footer_logo():
+    if not os.path.exists(LOGO_PATH):
+        return
+
+    st.markdown(FOOTER_LOGO_HTML, unsafe_allow_html=True)
 
 # --- 2. DATABASE ENGINE ---
-def init_db():
-    conn = sqlite3.connect("medical_guardian.db", check_same_thread=False)
+# Statements run on every chat turn. Passing the same literal each time
+# keeps them hot in the connection's prepared-statement cache.
+_INSERT_CHAT_SQL = "INSERT INTO chat_messages (username, role, content, timestamp, turn_id) VALUES (?,?,?,?,?)"
+_SELECT_SUMMARY_SQL = "SELECT summary, up_to_ts FROM chat_summary WHERE username=?"
+_SELECT_CACHED_RESPONSE_SQL = "SELECT response FROM response_cache WHERE key=? AND created>?"
+_UPSERT_CACHED_RESPONSE_SQL = "INSERT OR REPLACE INTO response_cache VALUES (?,?,?)"
+_PRUNE_CACHED_RESPONSES_SQL = "DELETE FROM response_cache WHERE created<=?"
+
+def _create_tables(conn):
     c = conn.cursor()
     c.execute("CREATE TABLE IF NOT EXISTS users (username TEXT PRIMARY KEY, password TEXT)")
     c.execute("""CREATE TABLE IF NOT EXISTS medical_history
                  (user_id TEXT, date TEXT, substance TEXT, dosage TEXT, reaction TEXT)""")
     c.execute("""CREATE TABLE IF NOT EXISTS chat_messages
-                 (username TEXT, role TEXT, content TEXT, timestamp DATETIME)""")
+                 (username TEXT, role TEXT, content TEXT, timestamp INTEGER, turn_id INTEGER)""")
+    c.execute("""CREATE TABLE IF NOT EXISTS chat_summary
+                 (username TEXT PRIMARY KEY, summary TEXT, up_to_ts INTEGER)""")
+    c.execute("""CREATE TABLE IF NOT EXISTS response_cache
+                 (key TEXT PRIMARY KEY, response TEXT, created REAL)""")
+    # Serve the per-user lookups and ORDER BY timestamp without a scan + sort
+    c.execute("CREATE INDEX IF NOT EXISTS idx_chat_user_ts ON chat_messages(username, timestamp)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_hist_user ON medical_history(user_id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_cache_created ON response_cache(created)")
+    # Timestamps are unix milliseconds; convert rows written as local-time
+    # datetime text by older versions (no-op once migrated).
+    c.execute("""UPDATE chat_messages
+                 SET timestamp = CAST(ROUND((julianday(timestamp, 'utc') - 2440587.5) * 86400000) AS INTEGER)
+                 WHERE typeof(timestamp) = 'text'""")
+    # Rows of one turn share turn_id, the rowid of the turn's first row.
+    # Older databases saved rows one at a time, where a reply belongs to the
+    # question directly before it; give those rows their turns once.
+    columns = [r[1] for r in c.execute("PRAGMA table_info(chat_messages)")]
+    if "turn_id" not in columns:
+        c.execute("ALTER TABLE chat_messages ADD COLUMN turn_id INTEGER")
+        rows = c.execute(
+            "SELECT rowid, username, role FROM chat_messages ORDER BY username, timestamp, rowid"
+        ).fetchall()
+        updates, prev = [], None
+        for rowid, username, role in rows:
+            if role == "assistant" and prev and prev[1:] == (username, "user"):
+                updates.append((prev[0], rowid))
+            else:
+                updates.append((rowid, rowid))
+            prev = (rowid, username, role)
+        c.executemany("UPDATE chat_messages SET turn_id=? WHERE rowid=?", updates)
     conn.commit()
-    return conn
 
-def save_chat_to_db(username, role, content):
-    conn = init_db()
-    conn.execute(
-        "INSERT INTO chat_messages VALUES (?,?,?,?)",
-        (username, role, content, datetime.now())
+class GuardianConnection(sqlite3.Connection):
+    # A connection has exactly one transaction, shared by every thread that
+    # uses it. Writers take this lock for the whole transaction so no thread
+    # commits or rolls back rows another one has only half written.
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.write_lock = threading.Lock()
+
+    @contextmanager
+    def transaction(self):
+        with self.write_lock, self:
+            yield self
+
+# One connection per process: the file open and schema DDL run exactly once,
+# not on every helper call and Streamlit rerun.
+@st.cache_resource
+def get_conn():
+    conn = sqlite3.connect(
+        DB_PATH,
+        check_same_thread=False,
+        cached_statements=256,
+        factory=GuardianConnection
     )
-    conn.commit()
+    # WAL turns each chat commit into a log append instead of a journal fsync,
+    # and lets readers proceed while a write is in flight. An in-memory
+    # database has no journal file to switch.
+    if DB_PATH != ":memory:":
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA journal_size_limit=67108864")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA busy_timeout=5000")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-20000")
+    conn.execute("PRAGMA mmap_size=268435456")
+    _create_tables(conn)
+    return conn
+
+def hash_password(password):
+    return PASSWORD_HASHER.hash(password)
+
+def verify_login(username, password):
+    conn = get_conn()
+    row = conn.execute(
+        "SELECT password FROM users WHERE username=?", (username,)
+    ).fetchone()
+    if row is None:
+        try:
+            PASSWORD_HASHER.verify(get_dummy_password_hash(), password)
+        except VerificationError:
+            pass
+        return False
+
+    stored = row[0]
+    if stored.startswith("$argon2"):
+        try:
+            PASSWORD_HASHER.verify(stored, password)
+        except (VerificationError, InvalidHashError):
+            return False
+        needs_rehash = PASSWORD_HASHER.check_needs_rehash(stored)
+    else:
+        # Accounts created before argon2: plain SHA-256 hex digest
+        legacy = hashlib.sha256(str.encode(password)).hexdigest()
+        if not hmac.compare_digest(stored, legacy):
+            return False
+        needs_rehash = True
+
+    if needs_rehash:
+        # Hashed before taking the write lock: the KDF must not stall every
+        # other session's writes
+        new_hash = hash_password(password)
+        with conn.transaction():
+            conn.execute(
+                "UPDATE users SET password=? WHERE username=?",
+                (new_hash, username)
+            )
+    return True
+
+def chat_timestamp():
+    # Unix ms: 8-byte integer compares and keys instead of datetime text
+    return int(time.time() * 1000)
+
+def save_question(username, content):
+    # A question opens its own turn: turn_id is its own rowid. The row is
+    # kept for deleting it later.
+    conn = get_conn()
+    ts = chat_timestamp()
+    with conn.transaction():
+        rowid = conn.execute(
+            _INSERT_CHAT_SQL, (username, "user", content, ts, None)
+        ).lastrowid
+        conn.execute(
+            "UPDATE chat_messages SET turn_id=? WHERE rowid=?",
+            (rowid, rowid)
+        )
+    return {"id": rowid, "role": "user", "content": content, "timestamp": ts, "turn": rowid}
+
+def save_reply(username, turns):
+    # turns: (questions, answer) pairs for questions saved before the stream,
+    # all written in one transaction; consecutive millisecond stamps keep
+    # their order. Questions sharing one answer are moved into the first
+    # one's turn; the question dicts are updated in place so the session's
+    # chat log agrees.
+    conn = get_conn()
+    base = chat_timestamp()
+    saved = []
+    with conn.transaction():
+        for i, (questions, answer) in enumerate(turns):
+            turn_id = questions[0]["turn"]
+            for q in questions[1:]:
+                conn.execute(
+                    "UPDATE chat_messages SET turn_id=? WHERE rowid=?",
+                    (turn_id, q["id"])
+                )
+                q["turn"] = turn_id
+            rowid = conn.execute(
+                _INSERT_CHAT_SQL, (username, "assistant", answer, base + i, turn_id)
+            ).lastrowid
+            saved.append(
+                {"id": rowid, "role": "assistant", "content": answer, "timestamp": base + i, "turn": turn_id}
+            )
+    return saved
 
 def load_chat_history(username, limit=50):
-    conn = init_db()
+    conn = get_conn()
     rows = conn.execute(
         """
-        SELECT role, content, timestamp
+        SELECT rowid, role, content, timestamp, turn_id
         FROM chat_messages
         WHERE username=?
-        ORDER BY timestamp ASC
+        ORDER BY timestamp DESC, rowid DESC
         LIMIT ?
         """,
-        (username, limit)
+        (username, -1 if limit is None else limit)
     ).fetchall()
-    return [{"role": r, "content": c, "timestamp": t} for r, c, t in rows]
+    # Newest rows were fetched first so LIMIT keeps the most recent turns
+    return [
+        {"id": i, "role": r, "content": c, "timestamp": t, "turn": turn}
+        for i, r, c, t, turn in reversed(rows)
+    ]
+
+def load_chat_summary(username):
+    row = get_conn().execute(
+        _SELECT_SUMMARY_SQL,
+        (username,)
+    ).fetchone()
+    return row if row else ("", None)
+
+def save_chat_summary(conn, username, summary, base_ts, covered):
+    # Only written if nothing changed while it was being generated: the
+    # summary it extends is still current and none of the messages it folds
+    # in was deleted. Otherwise it is dropped and rebuilt on a later turn.
+    ids = [m["id"] for m in covered]
+    with conn.transaction():
+        row = conn.execute(_SELECT_SUMMARY_SQL, (username,)).fetchone()
+        if (row[1] if row else None) != base_ts:
+            return False
+        alive = conn.execute(
+            f"SELECT COUNT(*) FROM chat_messages WHERE username=? AND rowid IN ({','.join('?' * len(ids))})",
+            (username, *ids)
+        ).fetchone()[0]
+        if alive != len(ids):
+            return False
+        conn.execute(
+            "INSERT OR REPLACE INTO chat_summary VALUES (?,?,?)",
+            (username, summary, covered[-1]["timestamp"])
+        )
+    return True
 
-def delete_chat_pair(username, user_timestamp):
-    conn = init_db()
-    c = conn.cursor()
+def load_medical_history(username):
+    return get_conn().execute(
+        "SELECT date, substance, dosage, reaction FROM medical_history WHERE user_id=?",
+        (username,)
+    ).fetchall()
 
-    c.execute(
-        "DELETE FROM chat_messages WHERE username=? AND role='user' AND timestamp=?",
-        (username, user_timestamp)
-    )
+def delete_chat_turn(username, rows):
+    conn = get_conn()
+    ids = [m["id"] for m in rows]
+    with conn.transaction():
+        # Straight rowid lookups; username only guards against stale ids
+        conn.execute(
+            f"DELETE FROM chat_messages WHERE username=? AND rowid IN ({','.join('?' * len(ids))})",
+            (username, *ids)
+        )
 
-    c.execute(
-        """
-        DELETE FROM chat_messages
-        WHERE username=? AND role='assistant'
-          AND timestamp > ?
-        ORDER BY timestamp ASC
-        LIMIT 1
-        """,
-        (username, user_timestamp)
-    )
-    conn.commit()
+        # A summary that covered the deleted turn is stale; it is rebuilt from
+        # the remaining history on a later turn.
+        conn.execute(
+            "DELETE FROM chat_summary WHERE username=? AND up_to_ts >= ?",
+            (username, rows[0]["timestamp"])
+        )
+
+def drop_chat_turn(chat_log, rows):
+    # In-memory mirror of delete_chat_turn for the session's cached chat log
+    dropped = {m["id"] for m in rows}
+    return [m for m in chat_log if m["id"] not in dropped]
+
+def get_cached_response(key):
+    row = get_conn().execute(
+        _SELECT_CACHED_RESPONSE_SQL,
+        (key, time.time() - RESPONSE_CACHE_TTL)
+    ).fetchone()
+    return row[0] if row else None
+
+def save_cached_response(conn, key, response):
+    now = time.time()
+    with conn.transaction():
+        conn.execute(
+            _UPSERT_CACHED_RESPONSE_SQL,
+            (key, response, now)
+        )
+        # Expired entries are never served again; drop them so the table
+        # stays bounded by what was cached within the TTL.
+        conn.execute(_PRUNE_CACHED_RESPONSES_SQL, (now - RESPONSE_CACHE_TTL,))
 
 def seed_demo_data(username):
-    conn = init_db()
-    c = conn.cursor()
+    conn = get_conn()
     if username.lower() == "user1":
         records = [
             ("2023-10-12", "Xanax (Alprazolam)", "0.5mg (Prescribed Daily)", "Anxiety management"),
@@ -118,19 +389,31 @@ def seed_demo_data(username):
     else:
         records = [("2025-01-01", "General", "N/A", "Initial baseline")]
 
-    for r in records:
-        c.execute(
+    with conn.transaction():
+        conn.executemany(
             "INSERT INTO medical_history VALUES (?,?,?,?,?)",
-            (username, r[0], r[1], r[2], r[3])
+            [(username, *r) for r in records]
         )
-    conn.commit()
 
 # --- 3. AI REASONING ENGINE ---
-def get_ai_response(user_input, history_df, username):
-    client = Groq(api_key=GROQ_API_KEY)
-    history_context = history_df.to_string(index=False)
+def format_history(history_rows):
+    # Pipe-separated rows instead of to_string()'s padded columns: same
+    # facts for the model, far fewer prompt tokens.
+    lines = ["date|substance|dosage|reaction"]
+    lines.extend(
+        f"{date}|{substance}|{dosage}|{reaction}"
+        for date, substance, dosage, reaction in history_rows
+    )
+    return "\n".join(lines)
+
+def choose_model(user_input):
+    # Short questions without any dosage math go to the ~3x faster 8B model;
+    # anything that mentions quantities keeps the 70B model.
+    if len(user_input) <= FAST_MODEL_MAX_CHARS and not DOSAGE_PATTERN.search(user_input):
+        return MODEL_FAST
+    return MODEL_QUALITY
 
-    system_msg = f"""
+SYSTEM_TEMPLATE = """
 You are a Medical Guardian AI and STRICTLY a medical assistant.
 
 DATABASE RECORDS FOUND:
@@ -159,25 +442,292 @@ MEDICAL RULES:
 4. Give safe guidance
 """
 
-    chat_history = load_chat_history(username)
+def batch_prompts(prompts):
+    # Questions sent while an earlier answer was still streaming are answered
+    # together: one request instead of paying the round-trip per question.
+    if len(prompts) == 1:
+        return prompts[0]
+    items = "\n".join(f"{i}. {p}" for i, p in enumerate(prompts, 1))
+    return (
+        "Answer each of these separately. Start each answer on its own line "
+        f"with its number in brackets, e.g. [1].\n{items}"
+    )
+
+def split_batched_reply(reply, count):
+    parts = BATCH_ANSWER_MARKER.split(reply)
+    if parts[1::2] != [str(i) for i in range(1, count + 1)]:
+        return None
+    answers = [p.strip() for p in parts[2::2]]
+    # Text before [1], e.g. a safety warning covering every question, stays
+    # with the first answer rather than being lost
+    if parts[0].strip():
+        answers[0] = f"{parts[0].strip()}\n\n{answers[0]}"
+    return answers
+
+def reply_turns(questions, reply):
+    # One turn per question/answer pair when the reply splits cleanly, so
+    # each can be deleted on its own; otherwise one turn holding every
+    # question and the shared reply.
+    answers = split_batched_reply(reply, len(questions)) if len(questions) > 1 else [reply]
+    if answers is None:
+        return [(questions, reply)]
+    return [([q], a) for q, a in zip(questions, answers)]
+
+def build_system_msg(history_context):
+    return SYSTEM_TEMPLATE.format(history_context=history_context)
+
+def warm_prompt_cache(system_msg):
+    # Throwaway 1-token completions so Groq has the per-user system prefix
+    # cached before the first real question. The prefix cache is per model
+    # and choose_model can send that question to either, so both are warmed.
+    # Runs on the worker pool and is best-effort: a failure here must never
+    # affect the session.
+    client = get_groq_client()
+
+    def _warm(model):
+        try:
+            client.chat.completions.create(
+                model=model,
+                messages=[{"role": "system", "content": system_msg}],
+                max_tokens=1
+            )
+        except Exception:
+            pass
+
+    for model in (MODEL_FAST, MODEL_QUALITY):
+        get_executor().submit(_warm, model)
+
+def response_cache_key(model, messages):
+    payload = json.dumps([model, messages], ensure_ascii=False).encode()
+    return hashlib.blake2b(payload, digest_size=32).hexdigest()
+
+def context_messages(chat_log, up_to_ts):
+    # Every message the summary doesn't cover yet goes verbatim, never fewer
+    # than CHAT_CONTEXT_LIMIT, so nothing falls between the two while the
+    # next summary batch is pending. Capped one batch above the window: a
+    # missing, failed or cleared summary must not send the whole log.
+    unsummarized = sum(1 for m in chat_log if up_to_ts is None or m["timestamp"] > up_to_ts)
+    keep = min(max(unsummarized, CHAT_CONTEXT_LIMIT), CHAT_CONTEXT_LIMIT + SUMMARY_EVERY)
+    return chat_log[-keep:]
+
+def _summarize_batch(client, summary, batch):
+    transcript = "\n".join(f"{m['role']}: {m['content']}" for m in batch)
+    completion = client.chat.completions.create(
+        model=MODEL_FAST,
+        messages=[
+            {
+                "role": "system",
+                "content": "Summarize this conversation between a user and a medical "
+                           "assistant in under 150 words. Keep every substance, dosage, "
+                           "symptom and piece of safety advice."
+            },
+            {
+                "role": "user",
+                "content": f"Previous summary:\n{summary or 'None'}\n\nNew messages:\n{transcript}"
+            }
+        ],
+        temperature=0
+    )
+    return completion.choices[0].message.content
+
+def _summarize_chat(client, conn, jobs, username, summary, up_to_ts, pending):
+    # Folds the backlog in SUMMARY_EVERY-sized batches, saving after each,
+    # so a long or rebuilt history never goes into one oversized call and a
+    # failure keeps the batches already done.
+    try:
+        for i in range(0, len(pending) - SUMMARY_EVERY + 1, SUMMARY_EVERY):
+            batch = pending[i:i + SUMMARY_EVERY]
+            summary = _summarize_batch(client, summary, batch)
+            if not save_chat_summary(conn, username, summary, up_to_ts, batch):
+                break
+            up_to_ts = batch[-1]["timestamp"]
+    except Exception:
+        pass
+    finally:
+        jobs.discard(username)
+
+def refresh_chat_summary(username, chat_log):
+    # Messages that fell out of the verbatim window are folded into the
+    # rolling summary in batches of SUMMARY_EVERY, off the script thread.
+    # The client and connection are resolved here: st.cache_resource needs
+    # the ScriptRunContext that worker threads don't have.
+    summary, up_to_ts = load_chat_summary(username)
+    pending = [
+        m for m in chat_log[:-CHAT_CONTEXT_LIMIT]
+        if up_to_ts is None or m["timestamp"] > up_to_ts
+    ]
+    jobs = get_summary_jobs()
+    if len(pending) < SUMMARY_EVERY or username in jobs:
+        return
+    jobs.add(username)
+    get_executor().submit(
+        _summarize_chat, get_groq_client(), get_conn(), jobs,
+        username, summary, up_to_ts, pending
+    )
+
+def _stream_completion(client, conn, model, messages, cache_key):
+    # Runs on the worker pool via stream_in_background
+    stream = client.chat.completions.create(
+        model=model,
+        messages=messages,
+        temperature=0,
+        stream=True
+    )
+
+    parts = []
+    try:
+        for chunk in stream:
+            delta = chunk.choices[0].delta.content
+            if delta:
+                parts.append(delta)
+                yield delta
+    finally:
+        stream.close()
+
+    save_cached_response(conn, cache_key, "".join(parts))
+
+def get_ai_response(user_input, system_msg, chat_history, summary=""):
+    # Everything up to the network request runs on the script thread, where
+    # the cached client and connection can be resolved; only the stream
+    # itself is handed to the worker pool.
+    client = get_groq_client()
 
     messages = [{"role": "system", "content": system_msg}]
+    # After the fixed system prompt so the cacheable prefix stays intact
+    if summary:
+        messages.append(
+            {"role": "system", "content": f"Summary of the earlier conversation:\n{summary}"}
+        )
     messages.extend(
         [{"role": m["role"], "content": m["content"]} for m in chat_history]
     )
     messages.append({"role": "user", "content": user_input})
 
-    completion = client.chat.completions.create(
-        model="llama-3.3-70b-versatile",
-        messages=messages,
-        temperature=0.2
-    )
-
-    return completion.choices[0].message.content
+    # temperature=0 keeps replies deterministic, so an identical request
+    # (same model, prompt and conversation) can be answered from the cache.
+    model = choose_model(user_input)
+    cache_key = response_cache_key(model, messages)
+    cached = get_cached_response(cache_key)
+    if cached is not None:
+        return iter([cached])
+
+    return _stream_completion(client, get_conn(), model, messages, cache_key)
+
+_STREAM_DONE = object()
+
+class StreamError(Exception):
+    # Failure reading the response. Kept apart from Streamlit's rerun and
+    # stop exceptions, which also surface from inside st.write_stream.
+    pass
+
+def stream_in_background(chunks):
+    # Drains a response iterator on the stream pool so network reads never
+    # block the script thread; tokens are handed over through a queue.
+    tokens = queue.Queue()
+    abandoned = threading.Event()
+
+    def _pump():
+        # Stops early once the reading run has gone away (interrupted by a
+        # rerun, or timed out) so the worker is freed for other sessions
+        try:
+            if abandoned.is_set():
+                return
+            for chunk in chunks:
+                tokens.put(chunk)
+                if abandoned.is_set():
+                    break
+        except Exception as exc:
+            tokens.put(exc)
+        finally:
+            if hasattr(chunks, "close"):
+                chunks.close()
+            tokens.put(_STREAM_DONE)
+
+    get_stream_executor().submit(_pump)
+    try:
+        while True:
+            try:
+                item = tokens.get(timeout=STREAM_TIMEOUT)
+            except queue.Empty:
+                raise StreamError("Timed out waiting for the model") from None
+            if item is _STREAM_DONE:
+                return
+            if isinstance(item, Exception):
+                raise StreamError(str(item)) from item
+            yield item
+    finally:
+        abandoned.set()
 
 # --- 4. UI FLOW ---
 st.set_page_config(page_title="Guardian AI", layout="centered")
-init_db()
+get_conn()
+
+def chat_turns(chat_log):
+    # user message id -> every row sharing its turn_id. Built over the whole
+    # log so a turn cut by the page edge is still deleted whole.
+    rows_by_turn = {}
+    for row in chat_log:
+        rows_by_turn.setdefault(row["turn"], []).append(row)
+    return {
+        row["id"]: rows_by_turn[row["turn"]]
+        for row in chat_log if row["role"] == "user"
+    }
+
+# chat_view's buttons rerun only the fragment, not auth, sidebar and session
+# setup. Their changes are made in on_click callbacks, which run before the
+# fragment (or a full run the click was merged into) renders, so nothing
+# has to call st.rerun.
+def _load_older_messages():
+    st.session_state.visible_messages += CHAT_PAGE_SIZE
+
+def _delete_picked_turn(username):
+    turns = chat_turns(st.session_state.chat_log)
+    picked = st.session_state.delete_pick
+    if picked not in turns:
+        return
+    delete_chat_turn(username, turns[picked])
+    st.session_state.chat_log = drop_chat_turn(
+        st.session_state.chat_log,
+        turns[picked]
+    )
+    st.session_state.delete_pick = None
+
+@st.fragment
+def chat_view(username):
+    # Only the most recent page of messages is rendered; older ones are
+    # revealed a page at a time, so rerun cost doesn't grow with the chat.
+    visible = st.session_state.setdefault("visible_messages", CHAT_PAGE_SIZE)
+    if len(st.session_state.chat_log) > visible:
+        st.button("Load older messages", on_click=_load_older_messages)
+
+    shown = st.session_state.chat_log[-visible:]
+    for row in shown:
+        with st.chat_message(row["role"]):
+            st.write(row["content"])
+
+    questions = {row["id"]: row for row in shown if row["role"] == "user"}
+    if not questions:
+        return
+
+    # One selector for the whole history instead of a button per message
+    col_pick, col_del = st.columns([5, 1], vertical_alignment="bottom")
+    with col_pick:
+        picked = st.selectbox(
+            "Delete a message",
+            options=list(questions),
+            index=None,
+            format_func=lambda msg_id: questions[msg_id]["content"][:80],
+            placeholder="Choose a message to delete",
+            key="delete_pick"
+        )
+    with col_del:
+        st.button(
+            "🗙 Delete",
+            disabled=picked is None,
+            type="secondary",
+            on_click=_delete_picked_turn,
+            args=(username,)
+        )
 
 if "logged_in" not in st.session_state:
     st.title("🛡️ Guardian AI: Secure Portal")
@@ -187,12 +737,7 @@ if "logged_in" not in st.session_state:
         u = st.text_input("Username")
         p = st.text_input("Password", type="password")
         if st.button("Log In"):
-            hashed = hashlib.sha256(str.encode(p)).hexdigest()
-            conn = init_db()
-            if conn.execute(
-                "SELECT * FROM users WHERE username=? AND password=?",
-                (u, hashed)
-            ).fetchone():
+            if verify_login(u, p):
                 st.session_state.logged_in = True
                 st.session_state.username = u
                 st.rerun()
@@ -203,11 +748,11 @@ if "logged_in" not in st.session_state:
         new_u = st.text_input("New Username")
         new_p = st.text_input("New Password", type="password")
         if st.button("Create Account"):
-            hashed = hashlib.sha256(str.encode(new_p)).hexdigest()
-            conn = init_db()
+            hashed = hash_password(new_p)
+            conn = get_conn()
             try:
-                conn.execute("INSERT INTO users VALUES (?,?)", (new_u, hashed))
-                conn.commit()
+                with conn.transaction():
+                    conn.execute("INSERT INTO users VALUES (?,?)", (new_u, hashed))
                 seed_demo_data(new_u)
                 st.success("Account created successfully.")
             except sqlite3.IntegrityError:
@@ -224,61 +769,88 @@ else:
 
     st.title("Guardian Crisis Interface")
 
-    conn = init_db()
-    hidden_history = pd.read_sql_query(
-        "SELECT * FROM medical_history WHERE user_id=?",
-        conn,
-        params=(st.session_state.username,)
-    )
+    # Loaded once per session; later reruns render from memory and only
+    # new or deleted messages touch the database.
+    if "chat_log" not in st.session_state:
+        st.session_state.history_context_str = format_history(
+            load_medical_history(st.session_state.username)
+        )
+        # Built once so every turn sends a byte-identical system prefix
+        st.session_state.system_msg = build_system_msg(
+            st.session_state.history_context_str
+        )
+        if GROQ_API_KEY:
+            warm_prompt_cache(st.session_state.system_msg)
+        st.session_state.chat_log = load_chat_history(
+            st.session_state.username, limit=None
+        )
+        # Long histories from before the rolling summary get their first
+        # summary built in the background now, not on the first turn
+        refresh_chat_summary(st.session_state.username, st.session_state.chat_log)
 
-    chat_log = pd.read_sql_query(
-        """
-        SELECT role, content, timestamp
-        FROM chat_messages
-        WHERE username=?
-        ORDER BY timestamp ASC
-        """,
-        conn,
-        params=(st.session_state.username,)
-    )
+    chat_view(st.session_state.username)
 
-    for _, row in chat_log.iterrows():
-        if row["role"] == "user":
-            col_msg, col_del = st.columns([20, 1])
-
-            with col_msg:
-                with st.chat_message("user"):
-                    st.write(row["content"])
-
-            with col_del:
-                if st.button(
-                    "🗙",
-                    key=f"del_{row['timestamp']}",
-                    help="Delete chat",
-                    type="secondary"
-                ):
-                    delete_chat_pair(
-                        st.session_state.username,
-                        row["timestamp"]
-                    )
-                    st.rerun()
-        else:
-            with st.chat_message("assistant"):
-                st.write(row["content"])
+    if st.session_state.pop("stream_failed", False):
+        st.error("The answer could not be completed. Your question was saved; please ask again.")
 
     if prompt := st.chat_input("What is happening?"):
+        # Saved before the stream, so the question survives a closed tab, a
+        # Logout or a restart mid-answer
+        question = save_question(st.session_state.username, prompt)
+        st.session_state.chat_log.append(question)
         with st.chat_message("user"):
             st.write(prompt)
-        save_chat_to_db(st.session_state.username, "user", prompt)
 
-        with st.spinner("Analyzing interactions..."):
-            response = get_ai_response(
-                prompt,
-                hidden_history,
-                st.session_state.username
-            )
+        # A prompt submitted mid-stream interrupts that run; its question
+        # stays queued here and is answered together with the new one.
+        pending = st.session_state.setdefault("pending_prompts", [])
+        pending.append(question)
+        pending_ids = {q["id"] for q in pending}
+        summary, up_to_ts = load_chat_summary(st.session_state.username)
+        chat_history = context_messages(
+            [m for m in st.session_state.chat_log if m["id"] not in pending_ids],
+            up_to_ts
+        )
 
-        with st.chat_message("assistant"):
-            st.markdown(response)
+        # Tokens render as they arrive; write_stream returns the full text
+        try:
+            with st.chat_message("assistant"):
+                response = st.write_stream(
+                    stream_in_background(
+                        get_ai_response(
+                            batch_prompts([q["content"] for q in pending]),
+                            st.session_state.system_msg,
+                            chat_history,
+                            summary
+                        )
+                    )
+                )
+        except StreamError:
+            # The questions are already saved and stay in the log unanswered.
+            # A rerun from a prompt sent mid-stream is not caught here, so
+            # those questions stay pending and are batched with the new one.
+            st.session_state.pending_prompts = []
+            st.session_state.stream_failed = True
+            st.rerun()
 
-        save_chat_to_db(st.session_state.username, "assistant", response)
+        # Answers to questions deleted while streaming have nothing to
+        # attach to and are not saved
+        live = {m["id"] for m in st.session_state.chat_log}
+        st.session_state.chat_log.extend(save_reply(
+            st.session_state.username,
+            [
+                (questions, answer)
+                for questions, answer in reply_turns(pending, response)
+                if any(q["id"] in live for q in questions)
+            ]
+        ))
+        st.session_state.pending_prompts = []
+        refresh_chat_summary(st.session_state.username, st.session_state.chat_log)
+        # The turn was drawn below chat_view; redraw it inside, or the next
+        # fragment-only rerun would show it twice
+        st.rerun()
+    else:
+        # A full run without a new prompt (Stop, a sidebar click) abandons
+        # any interrupted reply. Its questions stay in the log unanswered
+        # instead of being answered later alongside an unrelated one.
+        st.session_state.pending_prompts = []